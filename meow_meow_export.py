@@ -1,12 +1,16 @@
 import os
 import shutil
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import Callable
 
 # PhotoshopAPI dependencies
-import glob
 import psapi
 import numpy as np
-import imageio.v3 as iio
+from PIL import Image
 
 # Substance 3D Painter modules
 from substance_painter.layerstack import LayerNode, GroupLayerNode, TextureSet
@@ -21,13 +25,33 @@ from substance_painter.exception import ProjectError
 
 plugin_widgets = []
 node_visibility = dict()
+blending_modes = dict()
+contributing_nodes = dict()
+sub_layers = dict()
+layer_numbers = dict()
+export_configs = dict()  # Export configurations reused by export_textures()
+stack_roots = None  # Result of get_stack_roots() shared during an export
+flattened_nodes = None  # Result of flatten_nodes() shared during an export
+cache_cleanup = None  # Background thread deleting the cache of the last export
+cache_format = "tga"  # Written uncompressed, so cached layers skip zlib on export and on decode
+scratch_buffers = threading.local()  # CHW buffer reused by each decoder thread, see load_image_layer()
+copy_band_rows = 32  # Rows per band in load_chw, 32 rows of a 4096 wide RGBA image is 512 KB
+pending_psds = 2  # Texture sets decoded or written at once, each holds all of its layers in memory until written
+
+# Substance Painter blending mode -> psapi blend mode, normal map modes and modes psapi lacks are left out
+psapi_blending_modes = {mode: getattr(psapi.enum.BlendMode, name.lower())
+                        for name, mode in substance_painter.layerstack.BlendingMode.__members__.items()
+                        if not name.startswith("NormalMap") and hasattr(psapi.enum.BlendMode, name.lower())}
+normal_map_blending_modes = {mode for name, mode in substance_painter.layerstack.BlendingMode.__members__.items()
+                             if name.startswith("NormalMap")}
 
 # Note: name defaults to node.uid()
 def export_textures(node: LayerNode,
                     export_path: Path,
                     map_type: str = "documentMap",
                     map_name: str = "baseColor",
-                    name: str = None):
+                    name: str = None,
+                    file_format: str = "png"):
     # Verify if a project is open before trying to export something
     if not substance_painter.project.is_open():
         return
@@ -36,59 +60,66 @@ def export_textures(node: LayerNode,
     stack = node.get_stack()
     substance_painter.textureset.set_active_stack(stack)
 
-    # Build the configuration
-    export_config = {
-        "exportShaderParams": False,
-        "exportPath": str(export_path),
-        "defaultExportPreset": "2d_view",
-        "exportPresets": [
-            {"name": "2d_view",
-             "maps": [
-                 {
-                     "fileName": str(node.uid()) if name is None else name,
-                     "channels": [
-                         {
-                             "destChannel": "R",
-                             "srcChannel": "R",
-                             "srcMapType": map_type,
-                             "srcMapName": map_name,
-                         },
-                         {
-                             "destChannel": "G",
-                             "srcChannel": "G",
-                             "srcMapType": map_type,
-                             "srcMapName": map_name,
-                         },
-                         {
-                             "destChannel": "B",
-                             "srcChannel": "B",
-                             "srcMapType": map_type,
-                             "srcMapName": map_name,
-                         },
-                         {
-                             "destChannel": "A",
-                             "srcChannel": "A",
-                             "srcMapType": map_type,
-                             "srcMapName": map_name,
-                         },
-                     ],
-                     "parameters": {
-                         "fileFormat": "png",
-                         "bitDepth": "8",
-                         "dithering": False,
-                         "paddingAlgorithm": "transparent",
-                         "dilationDistance": 16,
+    # Build the configuration once per kind of map, only the file name and paths change between layers
+    config_key = (map_type, map_name, file_format)
+    if config_key not in export_configs:
+        export_configs[config_key] = {
+            "exportShaderParams": False,
+            "exportPath": None,
+            "defaultExportPreset": "2d_view",
+            "exportPresets": [
+                {"name": "2d_view",
+                 "maps": [
+                     {
+                         "fileName": None,
+                         "channels": [
+                             {
+                                 "destChannel": "R",
+                                 "srcChannel": "R",
+                                 "srcMapType": map_type,
+                                 "srcMapName": map_name,
+                             },
+                             {
+                                 "destChannel": "G",
+                                 "srcChannel": "G",
+                                 "srcMapType": map_type,
+                                 "srcMapName": map_name,
+                             },
+                             {
+                                 "destChannel": "B",
+                                 "srcChannel": "B",
+                                 "srcMapType": map_type,
+                                 "srcMapName": map_name,
+                             },
+                             {
+                                 "destChannel": "A",
+                                 "srcChannel": "A",
+                                 "srcMapType": map_type,
+                                 "srcMapName": map_name,
+                             },
+                         ],
+                         "parameters": {
+                             "fileFormat": file_format,
+                             "bitDepth": "8",
+                             "dithering": False,
+                             "paddingAlgorithm": "transparent",
+                             "dilationDistance": 16,
+                         }
                      }
+                 ],
                  }
-             ],
-             }
-        ],
-        "exportList": [
-            {
-                "rootPath": str(stack),
-            }
-        ]
-    }
+            ],
+            "exportList": [
+                {
+                    "rootPath": None,
+                }
+            ]
+        }
+
+    export_config = export_configs[config_key]
+    export_config["exportPath"] = str(export_path)
+    export_config["exportPresets"][0]["maps"][0]["fileName"] = str(node.uid()) if name is None else name
+    export_config["exportList"][0]["rootPath"] = str(stack)
 
     # Actual export operation:
     export_result = substance_painter.export.export_project_textures(export_config)
@@ -98,115 +129,280 @@ def export_textures(node: LayerNode,
         print(export_result.message)
 
 
+# Maps an uncompressed true-color TGA straight from disk as an HWC view in BGR(A) order
+# Returns None for anything else (RLE, color mapped, ...) so the caller can fall back to a decoder
+def map_tga(im_path: Path):
+    with open(im_path, "rb") as file:
+        header = file.read(18)
+
+    (id_length, color_map_type, image_type, _, _, _, _, _,
+     width, height, pixel_depth, descriptor) = struct.unpack("<BBBHHBHHHHBB", header)
+    if image_type != 2 or color_map_type or pixel_depth not in (24, 32) or descriptor & 0x10:
+        return None
+
+    image = np.memmap(im_path, np.uint8, mode="r", offset=18 + id_length, shape=(height, width, pixel_depth // 8))
+    if not descriptor & 0x20:  # Rows are stored bottom-up unless the top-left origin bit is set
+        image = image[::-1]
+
+    return image
+
+
+# Reads a cached layer image and returns it in psapi's channel-first (CHW) layout
+# Note: Written into out instead when it's given and matches the image size
+def load_chw(im_path: Path, out: np.ndarray = None):
+    if (image := map_tga(im_path)) is not None:
+        rgb = image[:, :, 2::-1]  # TGA stores pixels as BGR(A)
+
+    else:
+        # Anything map_tga() can't map is decoded by Pillow, np.asarray goes through Image.tobytes() here,
+        # so this path pays for an interleaved HWC copy on top of the decode before the CHW copy below
+        with Image.open(im_path) as decoded:
+            image = np.asarray(decoded if decoded.mode in ("RGB", "RGBA") else decoded.convert("RGBA"))
+
+        rgb = image[:, :, :3]
+
+    # Single HWC -> CHW copy straight out of the file mapping, pad a missing alpha as fully opaque
+    # Copied in bands of rows so each band of the interleaved source stays in cache while every
+    # channel is pulled out of it, rather than streaming the whole image from memory per channel
+    shape = (4, *image.shape[:2])
+    data = out if out is not None and out.shape == shape else np.empty(shape, np.uint8)
+    for row in range(0, image.shape[0], copy_band_rows):
+        rows = slice(row, row + copy_band_rows)
+        data[:3, rows] = rgb[rows].transpose(2, 0, 1)
+        data[3, rows] = image[rows, :, 3] if image.shape[2] == 4 else 255
+
+    return data
+
+
+# Decodes a cached layer into the calling thread's reusable CHW buffer and wraps it in a psapi layer
+# psapi copies the pixels into the layer, so the buffer is free for the next layer once this returns
+def load_image_layer(im_path: Path, name: str, blend_mode: psapi.enum.BlendMode):
+    data = scratch_buffers.data = load_chw(im_path, out=getattr(scratch_buffers, "data", None))
+    if data[3].min() == 255:
+        # Fully opaque, psapi writes no transparency channel for a 3 channel layer and Photoshop shows it as opaque
+        # With raw compression this leaves a 4096x4096 layer's 16 MB alpha plane out of the psd
+        data = data[:3]
+
+    return psapi.ImageLayer_8bit(data,
+                                 blend_mode=blend_mode,
+                                 layer_name=name,
+                                 height=4096,
+                                 width=4096)
+
+
+# Describes the psd of a texture set, given as the root nodes of each of its stacks,
+# as a flat list of (name, blend mode, image layer, parent index)
+# Groups have no image layer, parent index points at the enclosing group's entry (None for root)
+# Cached layer images are submitted to the decoder right away so they decode while the plan is built
+# Note: cached_files holds the file names in cache_path, so layers don't each need a stat call
+def plan_psd(stacks: list, cache_path: Path, cached_files: set, decoder: ThreadPoolExecutor):
+    layer_plan = []
+
+    for stack_root_nodes in stacks:
+        # Depth-first walk with an explicit stack of (node, parent index)
+        nodes = [(node, None) for node in reversed(stack_root_nodes)]
+
+        while nodes:
+            node, parent = nodes.pop()
+            if (blending_mode := get_psapi_blending_mode(node)) is None:
+                continue
+
+            if isinstance(node, GroupLayerNode):
+                if not subtree_contributes(node):
+                    continue  # Nothing below would end up in the psd, don't add an empty group
+
+                layer_plan.append((node.get_name(), blending_mode, None, parent))
+                group_index = len(layer_plan) - 1
+                nodes.extend((sub_node, group_index) for sub_node in reversed(get_sub_layers(node)))
+
+            elif isinstance(node, LayerNode):
+                file_name = f'{node.uid()}.{cache_format}'
+                if file_name not in cached_files:
+                    continue
+
+                name = node.get_name()
+                image_layer = decoder.submit(load_image_layer, cache_path.joinpath(file_name), name, blending_mode)
+                layer_plan.append((name, blending_mode, image_layer, parent))
+
+    return layer_plan
+
+
+# Builds the layers of a plan_psd() plan and writes them to psd_path
+def build_and_write_psd(layer_plan: list, psd_path: Path, compression: psapi.enum.Compression):
+    layered_file = psapi.LayeredFile_8bit(psapi.enum.ColorMode.rgb, 4096, 4096)  # Create file
+    group_layers = dict()
+
+    for index, (name, blend_mode, image_layer, parent) in enumerate(layer_plan):
+        if image_layer is None:
+            layer = group_layers[index] = psapi.GroupLayer_8bit(layer_name=name, blend_mode=blend_mode)
+
+        else:
+            layer = image_layer.result()
+
+        if parent is None:
+            layered_file.add_layer(layer)
+
+        else:
+            group_layers[parent].add_layer(layered_file=layered_file,
+                                           layer=layer)
+
+    layered_file.compression = compression
+    layered_file.write(psd_path)
+
+
 # TODO Add support for group layers, aswell as opacity
-def generate_psds(export_path: Path, cache_path: Path, delete_on_success: bool = False):
-    for texture_set in substance_painter.textureset.all_texture_sets():
-        layered_file = psapi.LayeredFile_8bit(psapi.enum.ColorMode.rgb, 4096, 4096)  # Create file
-
-        for stack in texture_set.all_stacks():
-            stack_root_nodes = substance_painter.layerstack.get_root_layer_nodes(stack)
-
-            def loop_nodes(nodes, group: psapi.GroupLayer_8bit = None):
-                for node in nodes:
-                    if isinstance(node, substance_painter.layerstack.GroupLayerNode):
-                        if get_psapi_blending_mode(node):
-                            group_layer = psapi.GroupLayer_8bit(layer_name=node.get_name(),
-                                                                blend_mode=get_psapi_blending_mode(node))
-                            if not group:
-                                layered_file.add_layer(group_layer)
-                                print(layered_file.layers)
-
-                            else:
-                                group.add_layer(layered_file=layered_file,
-                                                layer=group_layer)
-
-                            loop_nodes(node.sub_layers(), group=group_layer)
-
-                    elif isinstance(node, substance_painter.layerstack.LayerNode):
-                        if get_psapi_blending_mode(node):
-                            for im_path in glob.glob(os.path.join(cache_path, f'{str(node.uid())}.png')):
-                                image = iio.imread(im_path)
-
-                                data = np.zeros((image.shape[2], image.shape[0], image.shape[1]), np.uint8)
-                                data[0] = image[:, :, 0]
-                                data[1] = image[:, :, 1]
-                                data[2] = image[:, :, 2]
-                                data[3] = image[:, :, 3]
-
-                                layer = psapi.ImageLayer_8bit(data,
-                                                              blend_mode=get_psapi_blending_mode(node),
-                                                              layer_name=node.get_name(),
-                                                              height=4096,
-                                                              width=4096)
-
-                                if not group:
-                                    layered_file.add_layer(layer)
-
-                                else:
-                                    group.add_layer(layered_file=layered_file,
-                                                    layer=layer)
-
-            loop_nodes(stack_root_nodes)
-        print(layered_file.layers)
-        layered_file.compression = psapi.enum.Compression.rle
-        layered_file.write(Path(os.path.join(str(export_path), f"{texture_set}.psd")))
-
-    # Delete cache on completion
+# Note: raw compression writes fastest, use zip when file size matters
+# Note: When given, export_layer is called on every layer node of a texture set right before its psd is planned,
+# so a texture set's psd is decoded and written while the next texture set is still exporting
+def generate_psds(export_path: Path,
+                  cache_path: Path,
+                  delete_on_success: bool = False,
+                  compression: psapi.enum.Compression = psapi.enum.Compression.raw,
+                  export_layer: Callable[[LayerNode], None] = None):
+    global cache_cleanup
+
+    # Exports and plans need the Substance Painter API so they run here, while decoding and psd writing run on
+    # worker threads. Threads rather than processes, as a process pool would relaunch the host application
+    # from inside its embedded interpreter
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as decoder, ThreadPoolExecutor(pending_psds) as writer:
+        psd_writes = []
+        for texture_set, stacks in get_stack_roots():
+            if export_layer:
+                for node in flatten_nodes([(texture_set, stacks)])[1]:
+                    export_layer(node)
+
+            # Wait for the oldest psd before decoding another texture set, so only a few are held in memory
+            if len(psd_writes) >= pending_psds:
+                psd_writes.pop(0).result()
+
+            cached_files = set(os.listdir(cache_path))  # One directory listing instead of a stat per layer
+            layer_plan = plan_psd(stacks, cache_path, cached_files, decoder)
+            psd_writes.append(writer.submit(build_and_write_psd, layer_plan,
+                                            export_path.joinpath(f"{texture_set}.psd"),
+                                            compression))
+
+        for psd_write in psd_writes:
+            psd_write.result()  # Re-raise anything that went wrong while writing
+
+    # Delete cache on completion, in the background so control returns to the UI right away
     if delete_on_success:
-        shutil.rmtree(str(cache_path))
+        cache_cleanup = threading.Thread(target=shutil.rmtree,
+                                         args=(str(cache_path),),
+                                         kwargs=dict(ignore_errors=True),
+                                         daemon=True)
+        cache_cleanup.start()
 
 
-# Performs a method on every node
-def perform(func_layer: exec,
-            func_group: exec = None,
-            func_layer_args: list = None,
-            func_layer_kwargs: dict = None,
-            func_group_args: list = None,
-            func_group_kwargs: dict = None
-            ):
-    func_layer_args = func_layer_args or []
-    func_layer_kwargs = func_layer_kwargs or {}
-    func_group_args = func_group_args or []
-    func_group_kwargs = func_group_kwargs or {}
+# Returns [(texture set, [root nodes of each of its stacks])] for the whole project
+def get_stack_roots():
+    if stack_roots is not None:
+        return stack_roots
+
+    return [(texture_set, [substance_painter.layerstack.get_root_layer_nodes(stack)
+                           for stack in texture_set.all_stacks()])
+            for texture_set in substance_painter.textureset.all_texture_sets()]
 
-    for texture_set in substance_painter.textureset.all_texture_sets():
-        for stack in texture_set.all_stacks():
-            stack_root_nodes = substance_painter.layerstack.get_root_layer_nodes(stack)
 
-            def loop_nodes(nodes):
-                for node in nodes:
-                    if isinstance(node, substance_painter.layerstack.GroupLayerNode):
-                        if func_group:
-                            func_group(node, *func_group_args, **func_group_kwargs)
+# Walks every layer stack once, returns (group nodes, layer nodes) in layer stack order
+# Note: texture_sets defaults to get_stack_roots(), pass a part of it to only walk those texture sets
+def flatten_nodes(texture_sets: list = None):
+    group_nodes = []
+    layer_nodes = []
 
-                        loop_nodes(node.sub_layers())
+    for _, stacks in get_stack_roots() if texture_sets is None else texture_sets:
+        for stack_root_nodes in stacks:
+            nodes = list(reversed(stack_root_nodes))
 
-                    elif isinstance(node, substance_painter.layerstack.LayerNode):
-                        func_layer(node, *func_layer_args, **func_layer_kwargs)
+            while nodes:
+                node = nodes.pop()
+                if isinstance(node, GroupLayerNode):
+                    group_nodes.append(node)
+                    nodes.extend(reversed(get_sub_layers(node)))
 
-            loop_nodes(stack_root_nodes)
+                elif isinstance(node, LayerNode):
+                    layer_nodes.append(node)
+
+    return group_nodes, layer_nodes
+
+
+# Performs a method on every node
+# Note: Bind extra arguments with functools.partial, the methods are only passed the node
+def perform(func_layer: Callable[[LayerNode], None],
+            func_group: Callable[[GroupLayerNode], None] = None):
+    group_nodes, layer_nodes = flattened_nodes or flatten_nodes()
+
+    if func_group:
+        for node in group_nodes:
+            func_group(node)
+
+    for node in layer_nodes:
+        func_layer(node)
 
 
 def get_psapi_blending_mode(node: LayerNode):
-    blending_mode = node.get_blending_mode(channel=substance_painter.layerstack.ChannelType.BaseColor)
-    if blending_mode and not str(blending_mode).split('.')[1].startswith("NormalMap"):
-        return getattr(psapi.enum.BlendMode,
-                       str(node.get_blending_mode(substance_painter.layerstack.ChannelType.BaseColor)
-                           ).lower().split('.')[1])
+    # Blending modes don't change during an export, so only ask Substance Painter once per node
+    uid = str(node.uid())
+    if uid in blending_modes:
+        return blending_modes[uid]
+
+    painter_blending_mode = node.get_blending_mode(channel=substance_painter.layerstack.ChannelType.BaseColor)
+    blending_mode = psapi_blending_modes.get(painter_blending_mode)
+
+    # Normal map layers are exported on their own, anything else without a psapi counterpart is left out of the psd
+    if blending_mode is None and painter_blending_mode not in normal_map_blending_modes:
+        substance_painter.logging.log(substance_painter.logging.WARNING,
+                                      channel="Meow Meow Export",
+                                      message=f"Leaving {node.get_name()} out of the psd, "
+                                              f"its blending mode {painter_blending_mode.name} has no psd counterpart")
+
+    blending_modes[uid] = blending_mode
+    return blending_mode
+
+
+# Returns the sub layers of a group node, asking Substance Painter only once per group during an export
+def get_sub_layers(node: GroupLayerNode):
+    uid = str(node.uid())
+    if uid not in sub_layers:
+        sub_layers[uid] = node.sub_layers()
 
-    return None
+    return sub_layers[uid]
 
 
+# Whether a node, or for groups any layer below it, has a blending mode that ends up in the psd
+def subtree_contributes(node: LayerNode):
+    # Post-order walk with an explicit stack of (node, sub layers settled), a group is settled after
+    # everything below it, and settled nodes are remembered so each subtree is only walked once
+    nodes = [(node, False)]
+
+    while nodes:
+        current, sub_layers_settled = nodes.pop()
+        uid = str(current.uid())
+        if uid in contributing_nodes:
+            continue
+
+        if get_psapi_blending_mode(current) is None or not isinstance(current, GroupLayerNode):
+            contributing_nodes[uid] = get_psapi_blending_mode(current) is not None
+
+        elif sub_layers_settled:
+            contributing_nodes[uid] = any(contributing_nodes[str(sub_node.uid())]
+                                          for sub_node in get_sub_layers(current))
+
+        else:
+            nodes.append((current, True))
+            nodes.extend((sub_node, False) for sub_node in get_sub_layers(current))
+
+    return contributing_nodes[str(node.uid())]
+
 
 # Save dict containing visibility info for each object
 def save_state(node):
     node_visibility[str(node.uid())] = node.is_visible()
 
 
-# Toggle node transparency
-def set_visibility(node, visible: bool):
-    if not node.is_visible() == visible:
-        node.set_visible(visible)
+# Hide node, using the visibility save_state() recorded instead of asking Substance Painter again
+def hide_visible(node):
+    if node_visibility.get(str(node.uid())):
+        node.set_visible(False)
 
 
 # Reset node transparency
@@ -217,27 +413,33 @@ def reset_visibility(node):
 
 # Export node
 # Note: Extra path referring to png's that are different from baseColor
-def export(node: substance_painter.layerstack.LayerNode, export_path: Path, extra_path: Path):
-    layer_number = list(node_visibility).index(str(node.uid())) + 1
-    total_layers = len(node_visibility)
-
-    set_visibility(node, True)
+def export(node: substance_painter.layerstack.LayerNode, export_path: str, extra_path: str):
+    uid = str(node.uid())
+    name = node.get_name()
+    layer_number = layer_numbers[uid]
+    total_layers = len(layer_numbers)
+
+    # Every layer node is hidden before the export starts, so only this node needs toggling
+    node.set_visible(True)
     substance_painter.logging.log(substance_painter.logging.INFO,
                                   channel="Meow Meow Export",
                                   message=f"Exporting layer {layer_number} of {total_layers} "
-                                          f"({node.get_texture_set().name()}/{node.get_name()})...")
+                                          f"({node.get_texture_set().name()}/{name})...")
 
-    if str(node.get_blending_mode(substance_painter.layerstack.ChannelType.BaseColor)
-           ).split('.')[1].startswith("NormalMap"):
-        export_textures(node, export_path=extra_path, map_name='normal', name=node.get_name())
+    try:
+        if node.get_blending_mode(substance_painter.layerstack.ChannelType.BaseColor) in normal_map_blending_modes:
+            export_textures(node, export_path=extra_path, map_name='normal', name=name)
 
-    else:
-        export_textures(node, export_path=export_path)
+        else:
+            export_textures(node, export_path=export_path, name=uid, file_format=cache_format)
 
-    set_visibility(node, False)
+    finally:
+        node.set_visible(False)  # Hide it again even when the export failed, reset_visibility() only shows nodes
 
 
 def generate_textures():
+    global stack_roots, flattened_nodes
+
     # Check if active project is loaded
     try:
         export_path = substance_painter.project.file_path()
@@ -245,18 +447,47 @@ def generate_textures():
         substance_painter.logging.log(substance_painter.logging.ERROR, channel="Meow Meow Export", message=str(e))
         return
 
-    export_path = Path(os.path.join(os.path.dirname(export_path), "meow_meow_export"))  # Root export path (for psd)
-    cache_path = export_path.joinpath(".cache")  # Path for exported pngs
+    # Drop blending modes and sub layers cached by a previous export
+    blending_modes.clear()
+    contributing_nodes.clear()
+    sub_layers.clear()
+
+    # Let the previous export finish deleting its cache before this one writes into it
+    if cache_cleanup:
+        cache_cleanup.join()
+
+    export_path = Path(export_path).parent.joinpath("meow_meow_export")  # Root export path (for psd)
+    cache_path = export_path.joinpath(".cache")  # Path for exported layer images
 
     # Create folder if it doesn't exist
     cache_path.mkdir(parents=True, exist_ok=True)
 
-    perform(save_state)  # Save visibility info
-
-    perform(set_visibility, func_layer_kwargs=dict(visible=False))  # Hide all layer nodes
-    perform(export, func_layer_kwargs=dict(export_path=cache_path, extra_path=export_path))
-    perform(reset_visibility)
-    generate_psds(delete_on_success=True, export_path=export_path, cache_path=cache_path)
+    node_visibility.clear()  # Only restore what this export saw
+    try:
+        stack_roots = get_stack_roots()  # Ask Substance Painter for the layer stacks once per export
+        flattened_nodes = flatten_nodes()  # Walk the layer stacks once for every perform() below
+        perform(save_state)  # Save visibility info
+
+        # Number layers once for the export progress messages
+        layer_numbers.clear()
+        layer_numbers.update((uid, number) for number, uid in enumerate(node_visibility, start=1))
+
+        perform(hide_visible)  # Hide all layer nodes
+
+        # Layers are exported texture set by texture set, overlapping with the psds of finished texture sets
+        # Paths are converted for the export configuration once here rather than for every layer
+        generate_psds(delete_on_success=True, export_path=export_path, cache_path=cache_path,
+                      export_layer=partial(export, export_path=str(cache_path), extra_path=str(export_path)))
+
+    finally:
+        try:
+            # Restore the project's visibility even when an export or psd write failed
+            perform(reset_visibility)
+
+        finally:
+            # The layer stacks may change once this export is over
+            stack_roots = flattened_nodes = None
+            sub_layers.clear()
 
 
 def start_plugin():